@@ -1,21 +1,58 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g
+from flask.json.provider import JSONProvider, _default as flask_json_default
+from markupsafe import Markup
 from models import Book, Cart, User, Order, PaymentGateway, EmailService
+import orjson
+import secrets
 import uuid
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson's C encoder and decoder"""
+
+    # Hand dates to Flask's fallback so they keep the HTTP-date format
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=flask_json_default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = 'your_secret_key'  # Required for session management
 
 # Global storage for users and orders (in production, use a database)
 users = {}  # email -> User object
 orders = {}  # order_id -> Order object
 
+# Guards check-then-insert on users when served by threaded workers
+users_lock = threading.Lock()
+
+# Sends confirmation emails off the request thread (in production, use a task queue)
+email_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='email')
+
+
+def normalize_email(email):
+    """Helper function to canonicalise an email for use as a users key"""
+    return (email or '').strip().lower()
+
+
 # Create demo user for testing
-demo_user = User("demo@bookstore.com", "demo123", "Demo User", "123 Demo Street, Demo City, DC 12345")
-users["demo@bookstore.com"] = demo_user
+demo_user = User(normalize_email("demo@bookstore.com"), "demo123", "Demo User", "123 Demo Street, Demo City, DC 12345")
+users[demo_user.email] = demo_user
 
-# Create a cart instance to manage the cart
-cart = Cart()
+# Carts are kept per browser session (in production, use a database)
+carts = OrderedDict()  # cart_id -> Cart object, least recently stored first
+carts_lock = threading.Lock()
+MAX_CARTS = 10000  # Oldest carts are evicted beyond this
 
 # Create a global books list to avoid duplication
 BOOKS = [
@@ -25,21 +62,98 @@ BOOKS = [
     Book("Moby Dick", "Adventure", 12.49, "/images/books/moby_dick.jpg")
 ]
 
+# Discount code -> (rate, flash message prefix)
+DISCOUNT_CODES = {
+    'SAVE10': (0.10, 'Discount applied!'),
+    'WELCOME20': (0.20, 'Welcome discount applied!'),
+}
+
+# Flash message templates for messages that carry per-request values
+ADDED_TO_CART_MSG = 'Added {quantity} "{title}" to cart!'
+REMOVED_FROM_CART_MSG = 'Removed "{title}" from cart!'
+UPDATED_QUANTITY_MSG = 'Updated "{title}" quantity to {quantity}!'
+DISCOUNT_APPLIED_MSG = '{message} You saved ${saved:.2f}'
+MISSING_FIELD_MSG = 'Please fill in the {field} field'
+INVALID_QUANTITY_MSG = 'Invalid quantity. Please enter a number from 1 to {maximum}.'
+
+# Largest quantity accepted for a single cart line (matches the cart page input)
+MAX_QUANTITY = 99
+
+# Index the catalog by title once so lookups are O(1)
+BOOKS_BY_TITLE = {book.title: book for book in BOOKS}
+
+# Catalog grid HTML, rendered on first use; invalidate if BOOKS changes
+catalog_html = None
+
+
+def parse_quantity(value, minimum=1, maximum=MAX_QUANTITY):
+    """Helper function to parse a form quantity; returns None if invalid or out of range"""
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        return None
+    if (minimum is not None and quantity < minimum) or quantity > maximum:
+        return None
+    return quantity
+
+
 def get_book_by_title(title):
     """Helper function to find a book by title"""
-    return next((book for book in BOOKS if book.title == title), None)
+    return BOOKS_BY_TITLE.get(title)
+
+
+def get_catalog_html():
+    """Helper function to render the book catalog grid once and reuse it"""
+    global catalog_html
+    if catalog_html is None:
+        catalog_html = Markup(render_template('_catalog.html', books=BOOKS))
+    return catalog_html
 
 
 def get_current_user():
-    """Helper function to get current logged-in user"""
-    if 'user_email' in session:
-        return users.get(session['user_email'])
-    return None
+    """Helper function to get current logged-in user, looked up once per request"""
+    if 'current_user' not in g:
+        g.current_user = users.get(session.get('user_email'))
+    return g.current_user
+
+
+def get_cart(create=False):
+    """Helper function to get the cart for the current session.
+
+    Without create, a session that has no cart gets an empty Cart that is not
+    stored, so read-only visits don't leave carts behind.
+    """
+    cart_id = session.get('cart_id')
+    cart = carts.get(cart_id) if cart_id is not None else None
+    if cart is None:
+        cart = Cart()
+        if create:
+            if cart_id is None:
+                cart_id = session['cart_id'] = uuid.uuid4().hex
+            with carts_lock:
+                carts[cart_id] = cart
+                while len(carts) > MAX_CARTS:
+                    carts.popitem(last=False)
+    return cart
+
+
+def discard_cart_if_empty(cart):
+    """Helper function to drop the session's cart from storage once it holds nothing"""
+    cart_id = session.get('cart_id')
+    if cart_id is not None and cart.is_empty():
+        with carts_lock:
+            carts.pop(cart_id, None)
+
+
+def log_email_failure(future):
+    """Done-callback that logs an exception raised by a background email job"""
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error('Sending order confirmation email failed', exc_info=exc)
 
 
 def login_required(f):
     """Decorator to require login for certain routes"""
-    from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_email' not in session:
@@ -51,34 +165,31 @@ def login_required(f):
 
 @app.route('/')
 def index():
+    cart = get_cart()
     current_user = get_current_user()
-    return render_template('index.html', books=BOOKS, cart=cart, current_user=current_user)
+    return render_template('index.html', catalog_html=get_catalog_html(), cart=cart, current_user=current_user)
 
 
 @app.route('/add-to-cart', methods=['POST'])
 def add_to_cart():
+    cart = get_cart(create=True)
     book_title = request.form.get('title')
-    quantity_string = request.form.get('quantity', 1)
+    quantity = parse_quantity(request.form.get('quantity', 1))
     
-    # validate the quantity is a number
-    if not quantity_string.isdigit():
-        flash('Invalid quantity. Please enter a number.')
+    if quantity is None:
+        flash(INVALID_QUANTITY_MSG.format(maximum=MAX_QUANTITY), 'error')
         return redirect(url_for('index'))
     
-    # book = None
-    # for b in BOOKS:
-    #     if b.title == book_title:
-    #         book = b
-    #         break
-
-    # Improvement: use pre-existing get_book_by_title method instead looping through all books
     book = get_book_by_title(book_title)
-    
-    quantity = int(quantity_string)
 
     if book:
+        # The cap applies to the whole cart line, not just this add
+        existing = cart.items.get(book.title)
+        if existing is not None and existing.quantity + quantity > MAX_QUANTITY:
+            flash(INVALID_QUANTITY_MSG.format(maximum=MAX_QUANTITY), 'error')
+            return redirect(url_for('index'))
         cart.add_book(book, quantity)
-        flash(f'Added {quantity} "{book.title}" to cart!', 'success')
+        flash(ADDED_TO_CART_MSG.format(quantity=quantity, title=book.title), 'success')
     else:
         flash('Book not found!', 'error')
 
@@ -87,9 +198,11 @@ def add_to_cart():
 
 @app.route('/remove-from-cart', methods=['POST'])
 def remove_from_cart():
+    cart = get_cart()
     book_title = request.form.get('title')
     cart.remove_book(book_title)
-    flash(f'Removed "{book_title}" from cart!', 'success')
+    discard_cart_if_empty(cart)
+    flash(REMOVED_FROM_CART_MSG.format(title=book_title), 'success')
     return redirect(url_for('view_cart'))
 
 
@@ -105,51 +218,67 @@ def update_cart():
         Response: Redirects to the view_cart page after updating the cart.
     Form Parameters:
         title (str): The title of the book to update.
-        quantity (int): The new quantity of the book. Defaults to 1.
+        quantity (int): The new quantity of the book, at most MAX_QUANTITY. Defaults to 1.
     Flash Messages:
+        - Invalid quantity if the value is not an integer or exceeds MAX_QUANTITY
         - Confirmation of removal if quantity <= 0
         - Confirmation of update otherwise
     """
+    cart = get_cart()
     book_title = request.form.get('title')
-    quantity = int(request.form.get('quantity', 1))
+    # Zero or negative is allowed here and removes the item
+    quantity = parse_quantity(request.form.get('quantity', 1), minimum=None)
+    
+    if quantity is None:
+        flash(INVALID_QUANTITY_MSG.format(maximum=MAX_QUANTITY), 'error')
+        return redirect(url_for('view_cart'))
     
     cart.update_quantity(book_title, quantity)
+    discard_cart_if_empty(cart)
     
     if quantity <= 0:
-        flash(f'Removed "{book_title}" from cart!', 'success')
+        flash(REMOVED_FROM_CART_MSG.format(title=book_title), 'success')
     else:
-        flash(f'Updated "{book_title}" quantity to {quantity}!', 'success')
+        flash(UPDATED_QUANTITY_MSG.format(title=book_title, quantity=quantity), 'success')
     
     return redirect(url_for('view_cart'))
 
 
 @app.route('/cart')
 def view_cart():
+    cart = get_cart()
     current_user = get_current_user()
-    return render_template('cart.html', cart=cart, current_user=current_user)
+    rows, subtotal, item_count = cart.snapshot()
+    return render_template('cart.html', cart=cart, rows=rows, subtotal=subtotal,
+                           item_count=item_count, current_user=current_user)
 
 
 @app.route('/clear-cart', methods=['POST'])
 def clear_cart():
+    cart = get_cart()
     cart.clear()
+    discard_cart_if_empty(cart)
     flash('Cart cleared!', 'success')
     return redirect(url_for('view_cart'))
 
 
 @app.route('/checkout')
 def checkout():
+    cart = get_cart()
     if cart.is_empty():
         flash('Your cart is empty!', 'error')
         return redirect(url_for('index'))
     
     current_user = get_current_user()
-    total_price = cart.get_total_price()
-    return render_template('checkout.html', cart=cart, total_price=total_price, current_user=current_user)
+    rows, total_price, item_count = cart.snapshot()
+    return render_template('checkout.html', cart=cart, rows=rows, total_price=total_price,
+                           item_count=item_count, current_user=current_user)
 
 
 @app.route('/process-checkout', methods=['POST'])
 def process_checkout():
     """Process the checkout form with shipping and payment information"""
+    cart = get_cart()
     if cart.is_empty():
         flash('Your cart is empty!', 'error')
         return redirect(url_for('index'))
@@ -170,28 +299,26 @@ def process_checkout():
         'cvv': request.form.get('cvv')
     }
     
-    # discount_code = request.form.get('discount_code', '')
-    discount_code = request.form.get('discount_code', '').strip().upper() # discount code case sensitive issue fix
+    # Discount codes are matched case-insensitively
+    discount_code = (request.form.get('discount_code') or '').strip().upper()
     
     # Calculate total with discount
     total_amount = cart.get_total_price()
     discount_applied = 0
     
-    if discount_code == 'SAVE10':
-        discount_applied = total_amount * 0.10
-        total_amount -= discount_applied
-        flash(f'Discount applied! You saved ${discount_applied:.2f}', 'success')
-    elif discount_code == 'WELCOME20':
-        discount_applied = total_amount * 0.20
+    discount = DISCOUNT_CODES.get(discount_code)
+    if discount:
+        rate, message = discount
+        discount_applied = total_amount * rate
         total_amount -= discount_applied
-        flash(f'Welcome discount applied! You saved ${discount_applied:.2f}', 'success')
+        flash(DISCOUNT_APPLIED_MSG.format(message=message, saved=discount_applied), 'success')
     elif discount_code:
         flash('Invalid discount code', 'error')
     
     required_fields = ['name', 'email', 'address', 'city', 'zip_code']
     for field in required_fields:
         if not shipping_info.get(field):
-            flash(f'Please fill in the {field.replace("_", " ")} field', 'error')
+            flash(MISSING_FIELD_MSG.format(field=field.replace('_', ' ')), 'error')
             return redirect(url_for('checkout'))
     
     if payment_info['payment_method'] == 'credit_card':
@@ -207,7 +334,10 @@ def process_checkout():
         return redirect(url_for('checkout'))
     
     # Create order
-    order_id = str(uuid.uuid4())[:8].upper()
+    # 8 hex chars straight from 4 random bytes; redraw on the rare collision
+    order_id = secrets.token_hex(4).upper()
+    while order_id in orders:
+        order_id = secrets.token_hex(4).upper()
     order = Order(
         order_id=order_id,
         user_email=shipping_info['email'],
@@ -228,11 +358,13 @@ def process_checkout():
     if current_user:
         current_user.add_order(order)
     
-    # Send confirmation email (mock)
-    EmailService.send_order_confirmation(shipping_info['email'], order)
+    # Send confirmation email (mock) in the background so the response isn't held up
+    email_future = email_pool.submit(EmailService.send_order_confirmation, shipping_info['email'], order)
+    email_future.add_done_callback(log_email_failure)
     
     # Clear cart
     cart.clear()
+    discard_cart_if_empty(cart)
     
     # Store order in session for confirmation page
     session['last_order_id'] = order_id
@@ -259,8 +391,7 @@ def order_confirmation(order_id):
 def register():
     """User registration"""
     if request.method == 'POST':
-        # email = request.form.get('email')
-        email = request.form.get('email').strip().lower() # Fix: email case sensitivity issue
+        email = normalize_email(request.form.get('email'))
         password = request.form.get('password')
         name = request.form.get('name')
         address = request.form.get('address', '')
@@ -275,14 +406,17 @@ def register():
             flash('Please fill in all required fields', 'error')
             return render_template('register.html')
         
-        if email in users:
+        # Hash the password before locking; only the check and insert need the lock
+        user = User(email, password, name, address)
+        with users_lock:
+            email_taken = email in users
+            if not email_taken:
+                users[email] = user
+
+        if email_taken:
             flash('An account with this email already exists', 'error')
             return render_template('register.html')
         
-        # Create new user
-        user = User(email, password, name, address)
-        users[email] = user
-        
         # Log in the user
         session['user_email'] = email
         flash('Account created successfully! You are now logged in.', 'success')
@@ -295,11 +429,11 @@ def register():
 def login():
     """User login"""
     if request.method == 'POST':
-        email = request.form.get('email')
+        email = normalize_email(request.form.get('email'))
         password = request.form.get('password')
         
         user = users.get(email)
-        if user and user.password == password:
+        if user is not None and user.check_password(password):
             session['user_email'] = email
             flash('Logged in successfully!', 'success')
             return redirect(url_for('index'))
@@ -336,7 +470,7 @@ def update_profile():
     
     new_password = request.form.get('new_password')
     if new_password:
-        current_user.password = new_password
+        current_user.set_password(new_password)
         flash('Password updated successfully!', 'success')
     else:
         flash('Profile updated successfully!', 'success')
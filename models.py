@@ -1,4 +1,18 @@
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import random
+import time
+from operator import attrgetter
+
+logger = logging.getLogger(__name__)
+
+
 class Book:
+    __slots__ = ('title', 'category', 'price', 'image')
+
     def __init__(self, title, category, price, image):
         self.title = title
         self.category = category
@@ -7,6 +21,8 @@ class Book:
 
 
 class CartItem:
+    __slots__ = ('book', 'quantity')
+
     def __init__(self, book, quantity=1):
         self.book = book
         self.quantity = quantity
@@ -34,47 +50,43 @@ class Cart:
         clear(): Remove all items from the cart.
         get_items(): Return a list of all CartItem objects in the cart.
         is_empty(): Check if the cart has no items.
+        snapshot(): Return line totals, subtotal and item count in one pass.
     """
     def __init__(self):
         self.items = {}  # Using dict with book title as key for easy lookup
+        self._total_qty = 0  # Running count of books, kept in step with items
 
     def add_book(self, book, quantity=1):
         if book.title in self.items:
             self.items[book.title].quantity += quantity
         else:
             self.items[book.title] = CartItem(book, quantity)
+        self._total_qty += quantity
 
     def remove_book(self, book_title):
         if book_title in self.items:
-            del self.items[book_title]
+            self._total_qty -= self.items.pop(book_title).quantity
 
     def update_quantity(self, book_title, quantity):
         if book_title in self.items:
             if quantity <= 0:
                 # Fix: Automatically remove item if quantity <= 0
-                del self.items[book_title]
+                self._total_qty -= self.items.pop(book_title).quantity
             else:
-                self.items[book_title].quantity = quantity
+                item = self.items[book_title]
+                self._total_qty += quantity - item.quantity
+                item.quantity = quantity
 
     def get_total_price(self):
-        # total = 0
-        # for item in self.items.values():
-        #     for i in range(item.quantity):
-        #         total += item.book.price
-        # return total
-
-        # removed nested loop
-        total = 0
-        for item in self.items.values():
-                total += item.book.price * item.quantity
-        return total
-
+        # One multiply per title instead of one add per unit
+        return sum(item.book.price * item.quantity for item in self.items.values())
 
     def get_total_items(self):
-        return sum(item.quantity for item in self.items.values())
+        return self._total_qty
 
     def clear(self):
         self.items = {}
+        self._total_qty = 0
 
     def get_items(self):
         return list(self.items.values())
@@ -82,34 +94,77 @@ class Cart:
     def is_empty(self):
         return len(self.items) == 0
 
+    def snapshot(self):
+        """Return ([(item, line_total), ...], subtotal, item_count) from a single pass"""
+        rows = []
+        subtotal = 0
+        item_count = 0
+        for item in self.items.values():
+            line_total = item.book.price * item.quantity
+            rows.append((item, line_total))
+            subtotal += line_total
+            item_count += item.quantity
+        return rows, subtotal, item_count
+
+
+def _read_latency_ms(value):
+    """Parse a millisecond count, falling back to 0 so a bad value can't stop startup"""
+    try:
+        return max(int(value or 0), 0)
+    except ValueError:
+        logger.warning("Ignoring invalid PAYMENT_SIMULATED_LATENCY_MS=%r; expected whole milliseconds", value)
+        return 0
+
+
+# Optional mock gateway delay for local testing; off unless set in the environment
+PAYMENT_SIMULATED_LATENCY_MS = _read_latency_ms(os.environ.get('PAYMENT_SIMULATED_LATENCY_MS'))
+
+
+def _hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+
 
 class User:
     """User account management class"""
+    __slots__ = ('email', 'password_hash', 'salt', 'name', 'address', 'orders')
+
     def __init__(self, email, password, name="", address=""):
         self.email = email
-        self.password = password
+        self.set_password(password)
         self.name = name
         self.address = address
         self.orders = []
-        # self.temp_data = [] -- never used variable
-        # self.cache = {} -- never used variable
+
+    def set_password(self, password):
+        # Store a salted scrypt digest, never the plain text
+        self.salt = os.urandom(16)
+        self.password_hash = _hash_password(password, self.salt)
+
+    def check_password(self, password):
+        if not password:
+            return False
+        return hmac.compare_digest(self.password_hash, _hash_password(password, self.salt))
     
     def add_order(self, order):
+        # Orders are created in time order, so appending keeps them sorted by date
         self.orders.append(order)
-        # self.orders.sort(key=lambda x: x.order_date) ---- always sorting orders without a reason
     
-    def get_order_history(self, sorted_by_date = False):
-        # return [order for order in self.orders]
-        return sorted(self.orders, key=lambda x: x.order_date) if sorted_by_date else self.orders
+    def get_order_history(self, sorted_by_date=False):
+        # Return the list itself rather than a per-call copy
+        if sorted_by_date:
+            return sorted(self.orders, key=attrgetter('order_date'))
+        return self.orders
 
 
 class Order:
     """Order management class"""
+    __slots__ = ('order_id', 'user_email', 'items', 'shipping_info', 'payment_info',
+                 'total_amount', 'order_date', 'status')
+
     def __init__(self, order_id, user_email, items, shipping_info, payment_info, total_amount):
-        import datetime
         self.order_id = order_id
         self.user_email = user_email
-        self.items = items.copy()  # Copy of cart items
+        self.items = tuple(items)  # Immutable snapshot of cart items
         self.shipping_info = shipping_info
         self.payment_info = payment_info
         self.total_amount = total_amount
@@ -144,11 +199,8 @@ class PaymentGateway:
                 'transaction_id': None
             }
         
-        import random
-        import time
-        import datetime
-        
-        time.sleep(0.1)
+        if PAYMENT_SIMULATED_LATENCY_MS > 0:
+            time.sleep(PAYMENT_SIMULATED_LATENCY_MS / 1000)
         
         transaction_id = f"TXN{random.randint(100000, 999999)}"
         
@@ -5,23 +5,39 @@ import pytest
 # Add the parent directory to sys.path so imports work
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app, BOOKS, cart, users, get_book_by_title
-from models import Book, Cart, User, Order, PaymentGateway, EmailService
+import app as app_module
+from app import app, BOOKS, INVALID_QUANTITY_MSG, MAX_QUANTITY, OrjsonProvider, carts, orders, users, get_book_by_title, get_catalog_html
+import models
+from models import Book, Cart, CartItem, User, Order, PaymentGateway, EmailService
 
 import pytest
-from flask import session
+from flask import session, jsonify
 import timeit
 import cProfile
+import threading
+import datetime
+from collections import OrderedDict
+from concurrent.futures import Future
+from decimal import Decimal
+from markupsafe import Markup
 
 # Configure Flask for testing
 app.config['TESTING'] = True
 app.config['SECRET_KEY'] = 'test_secret'
 
+# Carts are per session, so pin the test client's session to a known cart
+TEST_CART_ID = 'test-cart'
+cart = Cart()
+carts[TEST_CART_ID] = cart
+
 @pytest.fixture
 def client():
     with app.test_client() as client:
         with client.session_transaction() as sess:
             sess.clear()
+            sess['cart_id'] = TEST_CART_ID
+        # Emptied carts are dropped from storage, so re-register the test cart
+        carts[TEST_CART_ID] = cart
         yield client
 
 @pytest.fixture(autouse=True)
@@ -55,6 +71,14 @@ def test_get_book_by_title_not_exists():
     book = get_book_by_title("Nonexistent Book")
     assert book is None
 
+def test_index_renders_cached_catalog(client):
+    # TC001-04: Home page lists every book from the cached catalog fragment
+    response = client.get('/')
+    for book in BOOKS:
+        assert book.title.encode() in response.data
+    with app.test_request_context():
+        assert get_catalog_html() is get_catalog_html()
+
 # ****************************
 # FR-002: Cart Functionality
 # ****************************
@@ -68,8 +92,40 @@ def test_add_to_cart(client):
 
 def test_add_invalid_quantity(client):
     # TC002-02: Edge case - invalid quantity input (non-integer)
-    response = client.post('/add-to-cart', data={'title': '1984', 'quantity': 'abc'})
-    assert b'Invalid quantity. Please enter a number.' in response.data or response.status_code == 302
+    cart.clear()
+    cart.add_book(BOOKS[1], 1)
+    response = client.post('/add-to-cart', data={'title': '1984', 'quantity': 'abc'}, follow_redirects=True)
+    assert INVALID_QUANTITY_MSG.format(maximum=MAX_QUANTITY).encode() in response.data
+    assert cart.items['1984'].quantity == 1
+    assert cart.get_total_items() == 1
+
+@pytest.mark.parametrize('quantity', ['', '0', '-2', '1.5', '1000000000'])
+def test_add_out_of_range_quantity(client, quantity):
+    # TC002-14: Non-positive, non-integer and oversized quantities are rejected
+    cart.clear()
+    response = client.post('/add-to-cart', data={'title': '1984', 'quantity': quantity}, follow_redirects=True)
+    assert b'Invalid quantity' in response.data
+    assert cart.is_empty()
+
+def test_add_repeatedly_stops_at_line_cap(client):
+    # TC002-16: Repeated adds cannot push one cart line past MAX_QUANTITY
+    cart.clear()
+    client.post('/add-to-cart', data={'title': '1984', 'quantity': 60})
+    response = client.post('/add-to-cart', data={'title': '1984', 'quantity': 60}, follow_redirects=True)
+    assert b'Invalid quantity' in response.data
+    assert cart.items['1984'].quantity == 60
+    client.post('/add-to-cart', data={'title': '1984', 'quantity': MAX_QUANTITY - 60})
+    assert cart.items['1984'].quantity == MAX_QUANTITY
+    client.post('/add-to-cart', data={'title': '1984', 'quantity': 1})
+    assert cart.items['1984'].quantity == MAX_QUANTITY
+
+def test_update_cart_invalid_quantity(client):
+    # TC002-15: Invalid update leaves the existing quantity alone
+    cart.clear()
+    cart.add_book(BOOKS[0], 2)
+    response = client.post('/update-cart', data={'title': BOOKS[0].title, 'quantity': 'abc'}, follow_redirects=True)
+    assert b'Invalid quantity' in response.data
+    assert cart.items[BOOKS[0].title].quantity == 2
 
 def test_remove_from_cart(client):
     # TC002-03: Remove book from cart
@@ -113,6 +169,94 @@ def test_remove_nonexistent_book(client):
     response = client.post('/remove-from-cart', data={'title': 'NotInCart'})
     assert response.status_code == 302  # Should redirect safely, not crash
 
+def test_cart_is_per_session():
+    # TC002-10: Each session gets its own cart
+    with app.test_client() as first, app.test_client() as second:
+        first.post('/add-to-cart', data={'title': '1984', 'quantity': 1})
+        with first.session_transaction() as sess:
+            first_cart = carts[sess['cart_id']]
+        response = second.get('/')
+        with second.session_transaction() as sess:
+            assert 'cart_id' not in sess
+    assert '1984' in first_cart.items
+    assert b'Cart (0)' in response.data
+
+def test_anonymous_browsing_does_not_store_carts():
+    # TC002-17: Read-only visits without a cart don't grow the carts store
+    before = len(carts)
+    with app.test_client() as anonymous:
+        for _ in range(5):
+            anonymous.get('/')
+            anonymous.get('/cart')
+            anonymous.get('/checkout')
+    assert len(carts) == before
+
+def test_cart_snapshot_totals():
+    # TC002-11: snapshot returns line totals, subtotal and item count together
+    snapshot_cart = Cart()
+    snapshot_cart.add_book(BOOKS[0], 2)
+    snapshot_cart.add_book(BOOKS[1], 3)
+    rows, subtotal, item_count = snapshot_cart.snapshot()
+    assert [(item.book.title, line_total) for item, line_total in rows] == [
+        (BOOKS[0].title, BOOKS[0].price * 2),
+        (BOOKS[1].title, BOOKS[1].price * 3),
+    ]
+    assert subtotal == pytest.approx(snapshot_cart.get_total_price())
+    assert item_count == snapshot_cart.get_total_items() == 5
+
+def test_cart_total_items_tracks_changes():
+    # TC002-13: Item count stays correct across add, update, remove and clear
+    counter_cart = Cart()
+    counter_cart.add_book(BOOKS[0], 2)
+    counter_cart.add_book(BOOKS[0], 3)
+    counter_cart.add_book(BOOKS[1], 1)
+    assert counter_cart.get_total_items() == 6
+    counter_cart.update_quantity(BOOKS[0].title, 1)
+    assert counter_cart.get_total_items() == 2
+    counter_cart.update_quantity(BOOKS[1].title, 0)
+    assert counter_cart.get_total_items() == 1
+    counter_cart.remove_book(BOOKS[0].title)
+    counter_cart.remove_book('Not In Cart')
+    assert counter_cart.get_total_items() == 0
+    counter_cart.add_book(BOOKS[2], 4)
+    counter_cart.clear()
+    assert counter_cart.get_total_items() == 0
+
+def test_view_cart_shows_totals(client):
+    # TC002-12: Cart page renders the snapshot totals
+    cart.clear()
+    cart.add_book(BOOKS[1], 2)
+    response = client.get('/cart')
+    assert b'Total Items: 2' in response.data
+    assert f'Total Price: ${BOOKS[1].price * 2:.2f}'.encode() in response.data
+
+def test_emptied_cart_is_dropped_from_storage():
+    # TC002-18: Clearing or emptying a cart removes it from the carts store
+    with app.test_client() as shopper:
+        shopper.post('/add-to-cart', data={'title': '1984', 'quantity': 1})
+        with shopper.session_transaction() as sess:
+            cart_id = sess['cart_id']
+        assert cart_id in carts
+        shopper.post('/clear-cart')
+        assert cart_id not in carts
+
+        shopper.post('/add-to-cart', data={'title': '1984', 'quantity': 1})
+        assert cart_id in carts
+        shopper.post('/remove-from-cart', data={'title': '1984'})
+        assert cart_id not in carts
+
+def test_carts_store_is_capped(monkeypatch):
+    # TC002-19: The oldest carts are evicted once MAX_CARTS is reached
+    monkeypatch.setattr(app_module, 'carts', OrderedDict())
+    monkeypatch.setattr(app_module, 'MAX_CARTS', 3)
+    cart_ids = []
+    for _ in range(5):
+        with app.test_client() as shopper:
+            shopper.post('/add-to-cart', data={'title': '1984', 'quantity': 1})
+            with shopper.session_transaction() as sess:
+                cart_ids.append(sess['cart_id'])
+    assert list(app_module.carts) == cart_ids[2:]
+
 # ****************************
 # FR-003: Checkout & Discounts
 # ****************************
@@ -188,6 +332,28 @@ def test_invalid_discount_code(client):
         assert 'Invalid discount code' in messages
         
 
+def test_welcome_discount_code_mixed_case(client):
+    # TC003-06: 'Welcome20' applies the 20% welcome discount
+    cart.clear()
+    cart.add_book(BOOKS[0], 1)
+    client.post('/process-checkout', data={
+        'name': 'Jane Doe',
+        'email': 'test@example.com',
+        'address': '123 Street',
+        'city': 'City',
+        'zip_code': '12345',
+        'payment_method': 'credit_card',
+        'card_number': '1234567890123456',
+        'expiry_date': '12/25',
+        'cvv': '123',
+        'discount_code': ' Welcome20 '
+    })
+
+    with client.session_transaction() as sess:
+        messages = [m for c, m in sess['_flashes']]
+    saved = BOOKS[0].price * 0.20
+    assert f'Welcome discount applied! You saved ${saved:.2f}' in messages
+
 def test_empty_payment_fields(client):
     # TC003-05: Checkout with missing payment info
     cart.add_book(BOOKS[0], 1)
@@ -239,6 +405,32 @@ def test_paypal_payment():
     assert result['success'] is True
     assert 'transaction_id' in result
 
+def test_payment_does_not_sleep_by_default(monkeypatch):
+    # TC004-04: No simulated latency unless PAYMENT_SIMULATED_LATENCY_MS is set
+    sleeps = []
+    monkeypatch.setattr(models.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(models, 'PAYMENT_SIMULATED_LATENCY_MS', models._read_latency_ms(None))
+    result = PaymentGateway.process_payment({'payment_method': 'credit_card', 'card_number': '1234567890123456'})
+    assert result['success'] is True
+    assert sleeps == []
+
+def test_payment_simulated_latency(monkeypatch):
+    # TC004-06: A configured latency makes the gateway sleep that long
+    sleeps = []
+    monkeypatch.setattr(models.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(models, 'PAYMENT_SIMULATED_LATENCY_MS', 150)
+    result = PaymentGateway.process_payment({'payment_method': 'credit_card', 'card_number': '1234567890123456'})
+    assert result['success'] is True
+    assert sleeps == [0.15]
+
+def test_payment_latency_setting_parsing(caplog):
+    # TC004-05: Invalid latency settings fall back to 0 with a warning
+    assert models._read_latency_ms(None) == 0
+    assert models._read_latency_ms('150') == 150
+    assert models._read_latency_ms('100ms') == 0
+    assert models._read_latency_ms('0.5') == 0
+    assert 'PAYMENT_SIMULATED_LATENCY_MS' in caplog.text
+
 # ****************************
 # FR-005: Order Confirmation
 # ****************************
@@ -256,6 +448,119 @@ def test_order_confirmation_creation():
     assert order.user_email == 'test@example.com'
     assert order.items[0].book.title == BOOKS[0].title
 
+def test_order_to_dict_json_response():
+    # TC005-03: Order.to_dict serializes through the app's JSON provider
+    order = Order(
+        order_id='ORD456',
+        user_email='test@example.com',
+        items=[CartItem(BOOKS[1], 2)],
+        shipping_info={'name': 'John', 'email': 'a@b.com', 'address': 'Addr', 'city': 'City', 'zip_code': '123'},
+        payment_info={'method': 'paypal', 'transaction_id': 'TXN456'},
+        total_amount=BOOKS[1].price * 2
+    )
+    assert isinstance(app.json, OrjsonProvider)
+    with app.app_context():
+        response = jsonify(order.to_dict())
+    assert response.mimetype == 'application/json'
+    data = response.get_json()
+    assert data['order_id'] == 'ORD456'
+    assert data['items'] == [{'title': BOOKS[1].title, 'quantity': 2, 'price': BOOKS[1].price}]
+
+def test_checkout_creates_order_id(client):
+    # TC005-04: Successful checkout stores an 8-char uppercase hex order ID
+    cart.clear()
+    cart.add_book(BOOKS[2], 1)
+    client.post('/process-checkout', data={
+        'name': 'John Doe',
+        'email': 'test@example.com',
+        'address': '123 Street',
+        'city': 'City',
+        'zip_code': '12345',
+        'payment_method': 'credit_card',
+        'card_number': '1234567890123456',
+        'expiry_date': '12/25',
+        'cvv': '123'
+    })
+    with client.session_transaction() as sess:
+        order_id = sess['last_order_id']
+    assert len(order_id) == 8
+    assert order_id == order_id.upper()
+    int(order_id, 16)
+    assert order_id in orders
+
+def test_checkout_sends_email_in_background(client, monkeypatch):
+    # TC005-05: Confirmation email is handed to the background pool
+    submitted = []
+    def fake_submit(fn, *args):
+        submitted.append((fn, args))
+        future = Future()
+        future.set_result(True)
+        return future
+    monkeypatch.setattr(app_module.email_pool, 'submit', fake_submit)
+    cart.clear()
+    cart.add_book(BOOKS[0], 1)
+    client.post('/process-checkout', data={
+        'name': 'John Doe',
+        'email': 'mail@example.com',
+        'address': '123 Street',
+        'city': 'City',
+        'zip_code': '12345',
+        'payment_method': 'credit_card',
+        'card_number': '1234567890123456',
+        'expiry_date': '12/25',
+        'cvv': '123'
+    })
+    assert len(submitted) == 1
+    fn, (email, order) = submitted[0]
+    assert fn is EmailService.send_order_confirmation
+    assert email == 'mail@example.com'
+    assert orders[order.order_id] is order
+
+def test_background_email_failure_is_logged(client, monkeypatch, caplog):
+    # TC005-06: An exception in the email job is logged, not lost
+    def failing_send(user_email, order):
+        raise RuntimeError('smtp down')
+    monkeypatch.setattr(EmailService, 'send_order_confirmation', staticmethod(failing_send))
+    futures = []
+    real_submit = app_module.email_pool.submit
+    def recording_submit(fn, *args):
+        future = real_submit(fn, *args)
+        futures.append(future)
+        return future
+    monkeypatch.setattr(app_module.email_pool, 'submit', recording_submit)
+    cart.clear()
+    cart.add_book(BOOKS[0], 1)
+    client.post('/process-checkout', data={
+        'name': 'John Doe',
+        'email': 'mail@example.com',
+        'address': '123 Street',
+        'city': 'City',
+        'zip_code': '12345',
+        'payment_method': 'credit_card',
+        'card_number': '1234567890123456',
+        'expiry_date': '12/25',
+        'cvv': '123'
+    })
+    assert len(futures) == 1
+    # Callbacks run in the order added, so this fires after the app's logger callback
+    logged = threading.Event()
+    futures[0].add_done_callback(lambda future: logged.set())
+    assert logged.wait(timeout=5)
+    assert 'Sending order confirmation email failed' in caplog.text
+    assert 'smtp down' in caplog.text
+
+def test_json_provider_keeps_flask_fallbacks():
+    # TC005-07: orjson provider still encodes the types Flask's default provider handles
+    assert app.json.loads(app.json.dumps({1: 'a'})) == {'1': 'a'}
+    assert app.json.dumps(Decimal('1.5')) == '"1.5"'
+    assert app.json.dumps(datetime.datetime(2020, 1, 1)) == '"Wed, 01 Jan 2020 00:00:00 GMT"'
+    assert app.json.dumps(Markup('<b>x</b>')) == '"<b>x</b>"'
+
+    class Html:
+        def __html__(self):
+            return '<i>y</i>'
+    assert app.json.dumps(Html()) == '"<i>y</i>"'
+
 def test_invalid_order_confirmation(client):
     # TC005-02: Invalid order ID should redirect
     response = client.get('/order-confirmation/INVALID999', follow_redirects=True)
@@ -294,6 +599,13 @@ def test_login_logout_user(client):
     response = client.get('/logout', follow_redirects=True)
     assert b'Logged out successfully' in response.data
 
+def test_login_email_case_insensitive(client):
+    # TC006-07: Login matches the account regardless of email case
+    response = client.post('/login', data={'email': ' Demo@Bookstore.com ', 'password': 'demo123'}, follow_redirects=True)
+    assert b'Logged in successfully' in response.data
+    with client.session_transaction() as sess:
+        assert sess['user_email'] == 'demo@bookstore.com'
+
 def test_invalid_email_registration(client):
     # TC006-04: Invalid email format
     response = client.post('/register', data={
@@ -318,6 +630,21 @@ def test_profile_update(client):
     }, follow_redirects=True)
     assert b'Profile updated successfully!' in response.data or response.status_code == 200
 
+def test_password_change_allows_new_login(client):
+    # TC006-08: Changed password replaces the old one
+    demo = users['demo@bookstore.com']
+    client.post('/login', data={'email': 'demo@bookstore.com', 'password': 'demo123'})
+    client.post('/update-profile', data={'name': demo.name, 'address': demo.address, 'new_password': 'changed456'})
+    try:
+        client.get('/logout')
+        response = client.post('/login', data={'email': 'demo@bookstore.com', 'password': 'changed456'}, follow_redirects=True)
+        assert b'Logged in successfully' in response.data
+        client.get('/logout')
+        response = client.post('/login', data={'email': 'demo@bookstore.com', 'password': 'demo123'}, follow_redirects=True)
+        assert b'Invalid email or password' in response.data
+    finally:
+        demo.set_password('demo123')
+
 # ****************************
 # FR-007: Responsive / Usability Placeholder
 # ****************************
@@ -350,9 +677,20 @@ def test_order_history_profile():
 # ****************************
 
 def test_password_storage_security():
-    # TC-S01: Check passwords stored as plain text
+    # TC-S01: Passwords are stored as salted hashes, not plain text
     user = users['demo@bookstore.com']
-    assert user.password == 'demo123'  # Need to fix: passwords are plain text
+    assert not hasattr(user, 'password')
+    assert user.password_hash != b'demo123'
+    assert user.check_password('demo123')
+    assert not user.check_password('wrongpassword')
+    assert not user.check_password('')
+
+def test_password_salt_is_per_user():
+    # TC-S03: Same password hashes differently for different users
+    first = User('a@example.com', 'secret')
+    second = User('b@example.com', 'secret')
+    assert first.salt != second.salt
+    assert first.password_hash != second.password_hash
 
 def test_email_case_insensitive_security(client):
     # TC-S02: Register email in different case should not allow duplicate